@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+
+DEFAULT_INDEX_PATH = 'keys_index.bin'
+
+BATCH_DIR_RE = re.compile(r'^keys_\d{8}$')
+KEY_FILE_RE = re.compile(r'^keys_(btc|eth)_(.+)\.txt$')
+CRYPTO_TYPES = ('btc', 'eth')
+
+# magic, bloom hash count, bloom size in bytes, record count
+HEADER = struct.Struct('<8sIQQ')
+# address key, batch id, crypto type
+RECORD = struct.Struct('<16sIB3x')
+MAGIC = b'ADDRIDX1'
+
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASH_COUNT = 7
+
+class CorruptIndexError(ValueError):
+    pass
+
+def normalize_address(address):
+    """ETH addresses are stored lowercase, BTC addresses are case sensitive"""
+    if address.lower().startswith('0x'):
+        return address.lower()
+    return address
+
+def address_key(address):
+    """Return the fixed-size index key for an address"""
+    return hashlib.sha256(normalize_address(address).encode('utf-8')).digest()[:16]
+
+def bloom_positions(key, num_bits, hash_count):
+    """Derive the bloom filter bit positions of a key by double hashing"""
+    h1 = int.from_bytes(key[:8], 'little')
+    h2 = int.from_bytes(key[8:], 'little') | 1
+    return [(h1 + i * h2) % num_bits for i in range(hash_count)]
+
+class AddressIndex:
+    """Sorted, memory-mapped address -> batch index with a bloom filter front"""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self.mm = None
+        self.root = None
+        self.batches = []
+        self.record_count = 0
+        self.hash_count = BLOOM_HASH_COUNT
+        self.bloom_bytes = 0
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        """Memory-map the index file"""
+        self.close()
+        corrupt = CorruptIndexError(f"Corrupt address index {self.path}, rebuild it with --update")
+        with open(self.path, 'rb') as f:
+            # mmap refuses empty files, so check the size before mapping
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise corrupt
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.hash_count, self.bloom_bytes, self.record_count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"Not an address index: {self.path}")
+
+        self.bloom_offset = HEADER.size
+        self.records_offset = self.bloom_offset + self.bloom_bytes
+        batches_offset = self.records_offset + self.record_count * RECORD.size
+        try:
+            table = json.loads(self.mm[batches_offset:].decode('utf-8'))
+            self.root = table['root']
+            self.batches = table['batches']
+        except (ValueError, KeyError, TypeError):
+            self.close()
+            raise corrupt
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def might_contain(self, key):
+        """Bloom filter check, False means the key is definitely not indexed"""
+        if self.mm is None or not self.record_count:
+            return False
+        for pos in bloom_positions(key, self.bloom_bytes * 8, self.hash_count):
+            if not self.mm[self.bloom_offset + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def record(self, idx):
+        return RECORD.unpack_from(self.mm, self.records_offset + idx * RECORD.size)
+
+    def lookup(self, address):
+        """Return every indexed key file for an address"""
+        address = normalize_address(address)
+        key = address_key(address)
+        if not self.might_contain(key):
+            return []
+
+        # Binary search for the first record with this key
+        lo, hi = 0, self.record_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        matches = []
+        while lo < self.record_count:
+            record_key, batch_id, type_code = self.record(lo)
+            if record_key != key:
+                break
+            crypto_type = CRYPTO_TYPES[type_code]
+            batch = self.batches[batch_id]['name']
+            matches.append({
+                'type': crypto_type,
+                'batch': batch,
+                'file': os.path.join(self.root, batch, f"keys_{crypto_type}_{address}.txt")
+            })
+            lo += 1
+        return matches
+
+    def contains(self, address):
+        return bool(self.lookup(address))
+
+    def scan_batch(self, root, name, batch_id):
+        """Collect the records and addresses of one batch directory"""
+        records = []
+        addresses = {}
+        for filename in os.listdir(os.path.join(root, name)):
+            match = KEY_FILE_RE.match(filename)
+            if not match:
+                continue
+            crypto_type, address = match.groups()
+            key = address_key(address)
+            records.append((key, batch_id, CRYPTO_TYPES.index(crypto_type)))
+            addresses[key] = address
+        records.sort()
+        return records, addresses
+
+    def update(self, root=None):
+        """Index new or modified batch directories, returns addresses found in more than one batch"""
+        # Batch names are relative to the root, which is stored in the index
+        root = os.path.abspath(root or self.root or '.')
+        # Batches indexed under another root are all replaced
+        rerooted = root != self.root
+        known = {} if rerooted else {batch['name']: batch for batch in self.batches}
+        current = {}
+        for name in sorted(os.listdir(root)):
+            if BATCH_DIR_RE.match(name) and os.path.isdir(os.path.join(root, name)):
+                current[name] = os.stat(os.path.join(root, name)).st_mtime_ns
+
+        # A directory's mtime changes whenever key files are added to it
+        changed = [name for name, mtime in current.items()
+                   if name not in known or known[name]['mtime_ns'] != mtime]
+        removed = [name for name in known if name not in current]
+        if not changed and not removed and not rerooted:
+            return []
+
+        # Keep the records of untouched batches, renumbering their batch ids
+        batches = []
+        remap = {}
+        for batch_id, batch in enumerate(self.batches):
+            if batch['name'] in known and batch['name'] in current and batch['name'] not in changed:
+                remap[batch_id] = len(batches)
+                batches.append(batch)
+        kept = [(key, remap[batch_id], type_code)
+                for key, batch_id, type_code in (self.record(i) for i in range(self.record_count))
+                if batch_id in remap]
+
+        sources = [kept]
+        addresses = {}
+        for name in changed:
+            records, batch_addresses = self.scan_batch(root, name, len(batches))
+            batches.append({'name': name, 'mtime_ns': current[name]})
+            sources.append(records)
+            addresses.update(batch_addresses)
+
+        records = list(heapq.merge(*sources))
+        self.write(records, root, batches)
+
+        # Equal keys are adjacent after the merge
+        collisions = []
+        for prev, record in zip(records, records[1:]):
+            if prev[0] == record[0] and record[0] in addresses:
+                if not collisions or collisions[-1]['key'] != record[0]:
+                    collisions.append({'key': record[0], 'address': addresses[record[0]],
+                                       'batches': [batches[prev[1]]['name']]})
+                collisions[-1]['batches'].append(batches[record[1]]['name'])
+        return collisions
+
+    def write(self, records, root, batches):
+        """Write sorted records and the bloom filter, then re-map the new file"""
+        num_bits = max(64, len(records) * BLOOM_BITS_PER_KEY)
+        bloom = bytearray((num_bits + 7) // 8)
+        num_bits = len(bloom) * 8
+        for key, _, _ in records:
+            for pos in bloom_positions(key, num_bits, BLOOM_HASH_COUNT):
+                bloom[pos >> 3] |= 1 << (pos & 7)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, BLOOM_HASH_COUNT, len(bloom), len(records)))
+            f.write(bloom)
+            for record in records:
+                f.write(RECORD.pack(*record))
+            f.write(json.dumps({'root': root, 'batches': batches}).encode('utf-8'))
+
+        self.close()
+        os.replace(tmp_path, self.path)
+        self.load()
+
+def main():
+    parser = argparse.ArgumentParser(description='Index archived key files by address')
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH,
+                      help=f'Path to the index file (default: {DEFAULT_INDEX_PATH})')
+    parser.add_argument('--update', action='store_true',
+                      help='Index new or modified keys_YYYYMMDD directories')
+    parser.add_argument('--root',
+                      help='Directory containing the keys_YYYYMMDD directories '
+                           '(default: the root stored in the index, else the current directory)')
+    parser.add_argument('--lookup', type=str,
+                      help='Look up which batch an address came from')
+    args = parser.parse_args()
+
+    if not args.update and not args.lookup:
+        parser.error("specify --update and/or --lookup")
+
+    try:
+        try:
+            index = AddressIndex(args.index)
+        except CorruptIndexError as e:
+            if not args.update:
+                raise
+            # A damaged index is rebuilt from scratch
+            print(f"Warning: {str(e)}")
+            os.remove(args.index)
+            index = AddressIndex(args.index)
+
+        if args.update:
+            collisions = index.update(args.root)
+            print(f"Indexed {index.record_count} addresses from {len(index.batches)} batches")
+            for collision in collisions:
+                print(f"Duplicate address {collision['address']} in batches: {', '.join(collision['batches'])}")
+
+        if args.lookup:
+            matches = index.lookup(args.lookup)
+            if not matches:
+                print(f"Address not found: {args.lookup}")
+                sys.exit(1)
+            for match in matches:
+                print(f"{match['type'].upper()} {args.lookup}: {match['file']}")
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
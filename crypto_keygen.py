@@ -4,14 +4,31 @@ import argparse
 from eth_keys import keys
 from bitcoinutils.setup import setup
 from bitcoinutils.keys import PrivateKey as BtcPrivateKey
+from Crypto.Cipher import AES
+from eth_utils import keccak
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from address_index import AddressIndex, DEFAULT_INDEX_PATH
 import secrets
 import binascii
+import getpass
+import hashlib
+import json
 import sys
 import qrcode
 import os
+import unicodedata
+import uuid
 from PIL import Image, ImageDraw, ImageFont
 from datetime import datetime
 
+# BIP38 fixes its scrypt parameters; decoders do not read them from the payload
+BIP38_SCRYPT_PARAMS = {'n': 16384, 'r': 8, 'p': 8}
+# Keystore v3 stores its parameters in the JSON, these match geth's defaults
+KEYSTORE_SCRYPT_PARAMS = {'n': 262144, 'r': 8, 'p': 1}
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
 def validate_private_key(private_key_input, crypto_type):
     """Validate and normalize private key input"""
     try:
@@ -64,6 +81,104 @@ def get_btc_address(private_key_hex):
         'address': btc_public_key.get_address().to_string()
     }
 
+def b58check_encode(payload):
+    """Base58Check encode a payload"""
+    data = payload + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    value = int.from_bytes(data, 'big')
+    encoded = ''
+    while value:
+        value, mod = divmod(value, 58)
+        encoded = B58_ALPHABET[mod] + encoded
+    leading_zeros = len(data) - len(data.lstrip(b'\x00'))
+    return B58_ALPHABET[0] * leading_zeros + encoded
+
+def scrypt(password, salt, n, r, p, dklen):
+    """Run scrypt with enough memory allowance for the given parameters"""
+    maxmem = 128 * r * (n + p + 2) + 1024 * 1024
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, dklen=dklen, maxmem=maxmem)
+
+def bip38_encrypt(private_key_hex, address, passphrase):
+    """Encrypt a private key for a compressed address as a BIP38 string"""
+    address_hash = hashlib.sha256(hashlib.sha256(address.encode('ascii')).digest()).digest()[:4]
+    password = unicodedata.normalize('NFC', passphrase).encode('utf-8')
+    derived = scrypt(password, address_hash, dklen=64, **BIP38_SCRYPT_PARAMS)
+    derived_half1, derived_half2 = derived[:32], derived[32:]
+    
+    private_key_bytes = binascii.unhexlify(private_key_hex)
+    xored = bytes(a ^ b for a, b in zip(private_key_bytes, derived_half1))
+    encrypted = AES.new(derived_half2, AES.MODE_ECB).encrypt(xored)
+    
+    # 0x0142 prefix, flag 0xe0 = no EC multiply + compressed public key
+    return b58check_encode(b'\x01\x42\xe0' + address_hash + encrypted)
+
+def derive_keystore_key(passphrase, salt, scrypt_params):
+    """Run the keystore scrypt KDF for a passphrase and salt"""
+    return scrypt(passphrase.encode('utf-8'), salt, dklen=32, **scrypt_params)
+
+def eth_keystore_encrypt(private_key_hex, address, derived, salt, scrypt_params):
+    """Encrypt a private key as an Ethereum keystore v3 JSON string using a derived key"""
+    iv = secrets.token_bytes(16)
+    
+    cipher = AES.new(derived[:16], AES.MODE_CTR, nonce=b'', initial_value=iv)
+    ciphertext = cipher.encrypt(binascii.unhexlify(private_key_hex))
+    mac = keccak(derived[16:32] + ciphertext)
+    
+    keystore = {
+        'address': address.lower().replace('0x', ''),
+        'crypto': {
+            'cipher': 'aes-128-ctr',
+            'cipherparams': {'iv': iv.hex()},
+            'ciphertext': ciphertext.hex(),
+            'kdf': 'scrypt',
+            'kdfparams': {
+                'dklen': 32,
+                'n': scrypt_params['n'],
+                'p': scrypt_params['p'],
+                'r': scrypt_params['r'],
+                'salt': salt.hex()
+            },
+            'mac': mac.hex()
+        },
+        'id': str(uuid.uuid4()),
+        'version': 3
+    }
+    return json.dumps(keystore, separators=(',', ':'))
+
+def encrypt_results(results, crypto_type, passphrase, scrypt_params=None, workers=None):
+    """Encrypt all private keys of a batch"""
+    if crypto_type == 'eth':
+        # The keystore stores its salt, so the batch shares one salt and a single scrypt
+        # derivation. Every key still gets its own random IV.
+        scrypt_params = scrypt_params or KEYSTORE_SCRYPT_PARAMS
+        salt = secrets.token_bytes(32)
+        derived = derive_keystore_key(passphrase, salt, scrypt_params)
+        encrypted = [
+            eth_keystore_encrypt(result['private_key'], result['address'], derived, salt, scrypt_params)
+            for result in results
+        ]
+    else:
+        # BIP38 salts scrypt with the address hash, so every key needs its own derivation
+        private_keys = [result['private_key_hex'] for result in results]
+        addresses = [result['address'] for result in results]
+        if len(results) == 1 or workers == 1:
+            encrypted = list(map(bip38_encrypt, private_keys, addresses, repeat(passphrase)))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunksize = max(1, len(results) // ((workers or os.cpu_count() or 1) * 4))
+                encrypted = list(executor.map(bip38_encrypt, private_keys, addresses,
+                                              repeat(passphrase), chunksize=chunksize))
+    
+    for result, encrypted_key in zip(results, encrypted):
+        result['encrypted_private_key'] = encrypted_key
+    return results
+
+def get_private_key_output(result, crypto_type):
+    """Return the label and value used for the private key in printed outputs"""
+    if 'encrypted_private_key' in result:
+        label = 'Private Key (BIP38)' if crypto_type.lower() == 'btc' else 'Private Key (Keystore V3)'
+        return label, result['encrypted_private_key']
+    return 'Private Key', result['private_key']
+
 def get_output_directory():
     current_date = datetime.now().strftime("%Y%m%d")
     dir_name = f"keys_{current_date}"
@@ -79,7 +194,10 @@ def save_to_file(result, crypto_type):
     filepath = os.path.join(output_dir, filename)
     
     with open(filepath, 'w') as f:
-        if crypto_type.lower() == 'btc':
+        if 'encrypted_private_key' in result:
+            label, encrypted_key = get_private_key_output(result, crypto_type)
+            f.write(f"{label}: {encrypted_key}\n")
+        elif crypto_type.lower() == 'btc':
             f.write(f"Private Key (WIF): {result['private_key']}\n")
             f.write(f"Private Key (HEX): {result['private_key_hex']}\n")
         else:
@@ -154,16 +272,24 @@ def create_qr_code(data, crypto_type):
 
 def create_combined_image(result, crypto_type):
     """Create a single image with both QR codes and addresses"""
-    qr_private = create_qr_code(result['private_key'], crypto_type)
+    private_key_label, private_key = get_private_key_output(result, crypto_type)
+    qr_private = create_qr_code(private_key, crypto_type)
     qr_address = create_qr_code(result['address'], crypto_type)
     
     qr_width = max(qr_private.size[0], qr_address.size[0])
     qr_private = qr_private.resize((qr_width, qr_width))
     qr_address = qr_address.resize((qr_width, qr_width))
     
+    # Short keys are split over two lines, keystore JSON is wrapped at 64 chars
+    chunk_size = len(private_key) // 2 if len(private_key) <= 128 else 64
+    private_key_lines = [
+        private_key[i:i + chunk_size]
+        for i in range(0, len(private_key), chunk_size)
+    ]
+    
     padding = 60
     extra_width = 750
-    text_height = 100
+    text_height = max(100, 25 * (len(private_key_lines) + 2))
     text_padding = 30
     
     total_width = (qr_width * 2) + (padding * 3) + extra_width
@@ -188,18 +314,11 @@ def create_combined_image(result, crypto_type):
     title_x = (total_width - title_width) // 2
     draw.text((title_x, padding // 2), title, font=title_font, fill='black')
 
-    private_key = result['private_key']
-    chunk_size = len(private_key) // 2
-    private_key_lines = [
-        private_key[i:i + chunk_size]
-        for i in range(0, len(private_key), chunk_size)
-    ]
-
     text_y = qr_width + padding - 10
     left_x = left_qr_x
     right_x = right_qr_x
 
-    draw.text((left_x, text_y), "Private Key:", font=font, fill='black')
+    draw.text((left_x, text_y), f"{private_key_label}:", font=font, fill='black')
     for i, line in enumerate(private_key_lines):
         y_pos = text_y + 25 + (i * 25)
         draw.text((left_x, y_pos), line, font=font, fill='black')
@@ -233,44 +352,58 @@ def create_merged_image(image_files):
     
     return filepath
 
-def generate_multiple_keys(count, crypto_type, decode_key=None, save_files=False):
+def get_address_details(private_key, crypto_type):
+    """Derive the address details of a hex private key"""
+    if crypto_type == 'eth':
+        return get_eth_address(private_key)
+    return get_btc_address(private_key)
+
+def generate_multiple_keys(count, crypto_type, decode_key=None, save_files=False,
+                           passphrase=None, scrypt_params=None, workers=None, index=None):
     """Generate multiple sets of keys and QR codes"""
     results = []
     image_files = []
     
     if decode_key:
         # When decoding, only process one key regardless of count
-        private_key = validate_private_key(decode_key, crypto_type)
-        if crypto_type == 'eth':
-            result = get_eth_address(private_key)
-        else:
-            result = get_btc_address(private_key)
+        result = get_address_details(validate_private_key(decode_key, crypto_type), crypto_type)
+        if index is not None:
+            for match in index.lookup(result['address']):
+                print(f"Warning: address was already issued in {match['file']}")
         results.append(result)
-        
-        # Save files only if requested
-        if save_files:
-            text_file = save_to_file(result, crypto_type)
-            image_file = create_combined_image(result, crypto_type)
-            image_files.append(image_file)
-        return results, image_files
+    else:
+        seen = set()
+        while len(results) < count:
+            result = get_address_details(generate_private_key(), crypto_type)
+            # Never hand out an address from this batch or an archived one twice
+            if result['address'] in seen or (index is not None and index.contains(result['address'])):
+                print(f"Warning: duplicate address {result['address']}, generating a new key")
+                continue
+            seen.add(result['address'])
+            results.append(result)
     
-    # Generate multiple new keys
-    for _ in range(count):
-        private_key = generate_private_key()
-        if crypto_type == 'eth':
-            result = get_eth_address(private_key)
-        else:
-            result = get_btc_address(private_key)
-        results.append(result)
-        
-        # Save files only if requested
-        if save_files:
+    # Encrypt the whole batch up front so the KDF work is shared or run in parallel
+    if passphrase is not None:
+        encrypt_results(results, crypto_type, passphrase, scrypt_params, workers)
+    
+    # Save files only if requested
+    if save_files:
+        for result in results:
             text_file = save_to_file(result, crypto_type)
             image_file = create_combined_image(result, crypto_type)
             image_files.append(image_file)
     
     return results, image_files
 
+def read_passphrase():
+    """Prompt for the encryption passphrase twice"""
+    passphrase = getpass.getpass("Encryption passphrase: ")
+    if not passphrase:
+        raise ValueError("Passphrase must not be empty")
+    if passphrase != getpass.getpass("Repeat passphrase: "):
+        raise ValueError("Passphrases do not match")
+    return passphrase
+
 def main():
     parser = argparse.ArgumentParser(description='Generate or decode crypto keys and addresses')
     parser.add_argument('--type', choices=['btc', 'eth'], required=True, 
@@ -281,19 +414,47 @@ def main():
                       help='Generate multiple keys (specify count)')
     parser.add_argument('--decode', type=str,
                       help='Decode existing private key (hex or WIF format)')
+    parser.add_argument('--encrypt', action='store_true',
+                      help='Output BIP38 (btc) or keystore v3 (eth) encrypted private keys')
+    parser.add_argument('--scrypt-n', type=int, default=KEYSTORE_SCRYPT_PARAMS['n'],
+                      help='Keystore scrypt N (eth only, BIP38 uses fixed parameters)')
+    parser.add_argument('--scrypt-r', type=int, default=KEYSTORE_SCRYPT_PARAMS['r'],
+                      help='Keystore scrypt r (eth only)')
+    parser.add_argument('--scrypt-p', type=int, default=KEYSTORE_SCRYPT_PARAMS['p'],
+                      help='Keystore scrypt p (eth only)')
+    parser.add_argument('--workers', type=int,
+                      help='Number of BIP38 encryption processes, each needs about 16 MB of scrypt memory (default: CPU count)')
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH,
+                      help=f'Address index checked for duplicates if it exists (default: {DEFAULT_INDEX_PATH})')
     args = parser.parse_args()
+    
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
 
     try:
         if args.multiply and args.decode:
             print("Warning: --multiply is ignored when --decode is specified")
         
+        passphrase = None
+        scrypt_params = None
+        if args.encrypt:
+            passphrase = read_passphrase()
+            scrypt_params = {'n': args.scrypt_n, 'r': args.scrypt_r, 'p': args.scrypt_p}
+        
+        index = AddressIndex(args.index) if os.path.exists(args.index) else None
+        
         count = args.multiply if args.multiply and not args.decode else 1
-        results, image_files = generate_multiple_keys(count, args.type, args.decode, save_files=args.qr)
+        results, image_files = generate_multiple_keys(count, args.type, args.decode, save_files=args.qr,
+                                                      passphrase=passphrase, scrypt_params=scrypt_params,
+                                                      workers=args.workers, index=index)
         
         for idx, result in enumerate(results, 1):
             if len(results) > 1:
                 print(f"\nKey Pair {idx}:")
-            if args.type == 'btc':
+            if args.encrypt:
+                label, encrypted_key = get_private_key_output(result, args.type)
+                print(f"{label}: {encrypted_key}")
+            elif args.type == 'btc':
                 print(f"Private key (WIF): {result['private_key']}")
                 print(f"Private key (HEX): {result['private_key_hex']}")
             else:
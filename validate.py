@@ -7,17 +7,37 @@ import pytesseract
 import cv2
 import numpy as np
 from pyzbar.pyzbar import decode
+from pyzbar.locations import Rect
 from eth_keys import keys
 from bitcoinutils.setup import setup
 from bitcoinutils.keys import PrivateKey as BtcPrivateKey
 import binascii
+import hashlib
+import json
 import re
 import sys
 import os
+from collections import namedtuple
+
+# Exposes data and rect like pyzbar's Decoded, plus the stage that decoded it
+QRDetection = namedtuple('QRDetection', ['data', 'rect', 'stage'])
+
+# (downscale factor, closing kernel size) of the levels used to locate QR codes.
+# The coarse level keeps codes apart from the key text printed right below them.
+PYRAMID_LEVELS = ((0.25, 1), (0.5, 3))
+# Adaptive threshold block sizes tried on regions the other decoders missed
+ADAPTIVE_BLOCK_SIZES = (31, 51, 101)
+# Per-region stages, then one pass over the rest of the image if codes are missing
+REGION_STAGES = ('pyzbar', 'opencv', 'adaptive')
+DECODE_STAGES = REGION_STAGES + ('full',)
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
 class KeyValidator:
     def __init__(self):
         setup('mainnet')
+        self.detector = cv2.QRCodeDetector()
+        self.stage_stats = {}
         
     def process_merged_image(self, image_path):
         """Read and preprocess the merged image"""
@@ -36,52 +56,212 @@ class KeyValidator:
             # Threshold
             _, threshold = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
             
-            return img, threshold
+            return img, gray, threshold
             
         except Exception as e:
             print(f"Error processing image: {str(e)}")
-            return None, None
+            return None, None, None
 
-    def extract_qr_codes(self, img, threshold):
-        """Extract and sort QR codes from image"""
+    def locate_qr_candidates(self, gray):
+        """Locate QR code regions on a downscaled image pyramid"""
+        boxes = []
+        for scale, kernel_size in PYRAMID_LEVELS:
+            small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            
+            # QR codes are dense blocks of edges, even when too blurred to decode at this size
+            edges = cv2.morphologyEx(small, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+            _, mask = cv2.threshold(edges, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+            if kernel_size > 1:
+                mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((kernel_size, kernel_size), np.uint8))
+            
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                x, y, w, h = cv2.boundingRect(contour)
+                # Keep solid, roughly square blobs, text lines are wide and small specks are noise
+                if min(w, h) < 15 or not 0.75 < w / h < 1.33 or cv2.contourArea(contour) < 0.6 * w * h:
+                    continue
+                boxes.append((int(x / scale), int(y / scale), int(w / scale), int(h / scale)))
+        
+        return self.merge_candidates(boxes, gray.shape)
+
+    def merge_candidates(self, boxes, shape):
+        """Drop boxes lying inside another one and pad the rest into regions"""
+        # Largest first, so finder patterns and the same code found at the other level are dropped
+        boxes = sorted(boxes, key=lambda box: box[2] * box[3], reverse=True)
+        kept = []
+        for x, y, w, h in boxes:
+            inside = False
+            for kx, ky, kw, kh in kept:
+                overlap_w = min(x + w, kx + kw) - max(x, kx)
+                overlap_h = min(y + h, ky + kh) - max(y, ky)
+                if overlap_w > 0 and overlap_h > 0 and overlap_w * overlap_h >= 0.8 * w * h:
+                    inside = True
+                    break
+            if not inside:
+                kept.append((x, y, w, h))
+        
+        regions = []
+        for x, y, w, h in kept:
+            # Pad by a quarter of the code size to keep the quiet zone
+            pad = max(w, h) // 4 + 10
+            regions.append([max(0, x - pad), max(0, y - pad),
+                            min(shape[1], x + w + pad), min(shape[0], y + h + pad)])
+        return regions
+
+    def find_detection(self, detections, rect):
+        """Return the detection whose box contains the centre of rect, if any"""
+        cx = rect.left + rect.width / 2
+        cy = rect.top + rect.height / 2
+        for detection in detections:
+            r = detection.rect
+            if r.left <= cx <= r.left + r.width and r.top <= cy <= r.top + r.height:
+                return detection
+        return None
+
+    def decode_with_pyzbar(self, image, offset, stage):
+        """Decode an image region with pyzbar, mapping rects back to the full image"""
+        x0, y0 = offset
+        return [
+            QRDetection(qr.data, Rect(qr.rect.left + x0, qr.rect.top + y0, qr.rect.width, qr.rect.height), stage)
+            for qr in decode(image)
+        ]
+
+    def decode_with_opencv(self, image, offset):
+        """Decode an image region with OpenCV's multi QR detector"""
+        x0, y0 = offset
+        detections = []
         try:
-            # Find QR codes
-            qr_codes = decode(threshold)
-            
-            # Sort QR codes by vertical position first, then horizontal
-            sorted_qr_codes = sorted(qr_codes, key=lambda qr: (qr.rect.top, qr.rect.left))
-            
-            # Group QR codes into pairs
-            pairs = []
-            current_pair = []
-            current_y = None
+            found, decoded_info, points, _ = self.detector.detectAndDecodeMulti(image)
+        except cv2.error:
+            return detections
+        if not found or points is None:
+            return detections
+        
+        for data, quad in zip(decoded_info, points):
+            if not data:
+                continue
+            x, y, w, h = cv2.boundingRect(quad.astype(np.float32))
+            detections.append(QRDetection(data.encode('utf-8'), Rect(x + x0, y + y0, w, h), 'opencv'))
+        return detections
+
+    def decode_with_adaptive(self, image, offset):
+        """Decode an image region with pyzbar over increasingly coarse adaptive thresholds"""
+        for block_size in ADAPTIVE_BLOCK_SIZES:
+            binary = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                           cv2.THRESH_BINARY, block_size, 10)
+            detections = self.decode_with_pyzbar(binary, offset, 'adaptive')
+            if detections:
+                return detections
+        return []
+
+    def decode_region(self, gray, threshold, region):
+        """Decode one candidate region, escalating through the decoding stages"""
+        x1, y1, x2, y2 = region
+        offset = (x1, y1)
+        gray_region = gray[y1:y2, x1:x2]
+        
+        stages = {
+            'pyzbar': lambda: self.decode_with_pyzbar(threshold[y1:y2, x1:x2], offset, 'pyzbar'),
+            'opencv': lambda: self.decode_with_opencv(gray_region, offset),
+            'adaptive': lambda: self.decode_with_adaptive(gray_region, offset)
+        }
+        
+        # Only regions that are still unresolved go on to the next stage
+        for stage in REGION_STAGES:
+            self.stage_stats[stage]['attempts'] += 1
+            detections = stages[stage]()
+            if detections:
+                self.stage_stats[stage]['hits'] += 1
+                return detections
+        return []
+
+    def decode_remaining(self, threshold, qr_codes):
+        """Run pyzbar once over the full threshold image with the decoded codes masked out"""
+        masked = threshold.copy()
+        for qr in qr_codes:
+            r = qr.rect
+            pad = max(r.width, r.height) // 8
+            masked[max(0, r.top - pad):r.top + r.height + pad,
+                   max(0, r.left - pad):r.left + r.width + pad] = 255
+        
+        self.stage_stats['full']['attempts'] += 1
+        detections = self.decode_with_pyzbar(masked, (0, 0), 'full')
+        if detections:
+            self.stage_stats['full']['hits'] += 1
+        return detections
+
+    def report_stage_stats(self):
+        """Print how many regions each decoding stage was tried on and resolved"""
+        print("QR decoding stages:")
+        for stage in DECODE_STAGES:
+            stats = self.stage_stats[stage]
+            unit = 'regions' if stage in REGION_STAGES else 'passes'
+            rate = 100.0 * stats['hits'] / stats['attempts'] if stats['attempts'] else 0.0
+            print(f"  {stage:<9} {stats['hits']}/{stats['attempts']} {unit} ({rate:.0f}%)")
+
+    def pair_qr_codes(self, qr_codes):
+        """Sort QR codes and group them into (private key, address) pairs"""
+        # Sort QR codes by vertical position first, then horizontal
+        sorted_qr_codes = sorted(qr_codes, key=lambda qr: (qr.rect.top, qr.rect.left))
+        
+        # Group QR codes into pairs
+        pairs = []
+        current_pair = []
+        current_y = None
+        
+        for qr in sorted_qr_codes:
+            if current_y is None:
+                current_y = qr.rect.top
             
-            for qr in sorted_qr_codes:
-                if current_y is None:
-                    current_y = qr.rect.top
-                
-                # If we're significantly far from the last y position, it's a new pair
-                if abs(qr.rect.top - current_y) > 100:
-                    if current_pair:
-                        current_pair.sort(key=lambda qr: qr.rect.left)
-                        pairs.append(current_pair)
-                        current_pair = []
-                    current_y = qr.rect.top
-                
-                current_pair.append(qr)
-                
-                # If we have 2 QR codes in current pair, add it to pairs
-                if len(current_pair) == 2:
+            # If we're significantly far from the last y position, it's a new pair
+            if abs(qr.rect.top - current_y) > 100:
+                if current_pair:
                     current_pair.sort(key=lambda qr: qr.rect.left)
                     pairs.append(current_pair)
                     current_pair = []
-                    current_y = None
+                current_y = qr.rect.top
+            
+            current_pair.append(qr)
             
-            # Add any remaining pair
-            if current_pair:
+            # If we have 2 QR codes in current pair, add it to pairs
+            if len(current_pair) == 2:
                 current_pair.sort(key=lambda qr: qr.rect.left)
                 pairs.append(current_pair)
-            
+                current_pair = []
+                current_y = None
+        
+        # Add any remaining pair
+        if current_pair:
+            current_pair.sort(key=lambda qr: qr.rect.left)
+            pairs.append(current_pair)
+        
+        return pairs
+
+    def extract_qr_codes(self, gray, threshold):
+        """Extract and sort QR codes from image"""
+        try:
+            self.stage_stats = {stage: {'attempts': 0, 'hits': 0} for stage in DECODE_STAGES}
+            
+            qr_codes = []
+            failed_regions = 0
+            for region in self.locate_qr_candidates(gray):
+                detections = self.decode_region(gray, threshold, region)
+                if not detections:
+                    failed_regions += 1
+                for detection in detections:
+                    if self.find_detection(qr_codes, detection.rect) is None:
+                        qr_codes.append(detection)
+            
+            # The locator can miss codes, so look at the rest of the image whenever
+            # nothing was found, a region failed or a pair is incomplete
+            pairs = self.pair_qr_codes(qr_codes)
+            if not qr_codes or failed_regions or any(len(pair) < 2 for pair in pairs):
+                for detection in self.decode_remaining(threshold, qr_codes):
+                    if self.find_detection(qr_codes, detection.rect) is None:
+                        qr_codes.append(detection)
+                pairs = self.pair_qr_codes(qr_codes)
+            
+            self.report_stage_stats()
             return pairs
             
         except Exception as e:
@@ -164,8 +344,67 @@ class KeyValidator:
             print(f"Error extracting text from region: {str(e)}")
             return ""
         
+    def b58check_decode(self, encoded):
+        """Decode a Base58Check string, raising ValueError on a bad checksum"""
+        value = 0
+        for char in encoded:
+            value = value * 58 + B58_ALPHABET.index(char)
+        data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+        data = b'\x00' * (len(encoded) - len(encoded.lstrip(B58_ALPHABET[0]))) + data
+        payload, checksum = data[:-4], data[-4:]
+        if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+            raise ValueError("Invalid Base58Check checksum")
+        return payload
+
+    def validate_bip38_key_pair(self, encrypted_key, address):
+        """Check a BIP38 key against the address without the passphrase"""
+        try:
+            print(f"\nValidating BTC pair:")
+            print(f"Private Key (BIP38): {encrypted_key}")
+            print(f"Address: {address}")
+            
+            payload = self.b58check_decode(encrypted_key)
+            if len(payload) != 39 or payload[:2] != b'\x01\x42':
+                print("Not a BIP38 encrypted key without EC multiply")
+                return False
+            
+            # Bytes 3-7 hold the first 4 bytes of sha256d(address)
+            address_hash = hashlib.sha256(hashlib.sha256(address.encode('ascii')).digest()).digest()[:4]
+            matches = payload[3:7] == address_hash
+            print("Encrypted key, passphrase not checked: only the BIP38 address hash is validated")
+            if not matches:
+                print(f"Address hash mismatch:")
+                print(f"Encrypted key: {payload[3:7].hex()}")
+                print(f"Address:       {address_hash.hex()}")
+            return matches
+            
+        except Exception as e:
+            print(f"Error validating BIP38 pair: {str(e)}")
+            return False
+
+    def validate_keystore_key_pair(self, keystore_json, address):
+        """Check a keystore v3 JSON against the address without the passphrase"""
+        try:
+            keystore = json.loads(keystore_json)
+            keystore_address = keystore['address'].lower().replace('0x', '')
+            address = address.lower().replace('0x', '')
+            
+            matches = keystore_address == address
+            print("Encrypted key, passphrase not checked: only the keystore address field is validated")
+            if not matches:
+                print(f"Address mismatch:")
+                print(f"Keystore: {keystore_address}")
+                print(f"Expected: {address}")
+            return matches
+            
+        except Exception as e:
+            print(f"Error validating keystore pair: {str(e)}")
+            return False
+
     def validate_btc_key_pair(self, private_key, address):
         """Validate Bitcoin key pair"""
+        if private_key.startswith('6P'):
+            return self.validate_bip38_key_pair(private_key, address)
         try:
             print(f"\nValidating BTC pair:")
             print(f"Private Key (WIF): {private_key}")
@@ -188,6 +427,8 @@ class KeyValidator:
 
     def validate_eth_key_pair(self, private_key, address):
         """Validate Ethereum key pair"""
+        if private_key.lstrip().startswith('{'):
+            return self.validate_keystore_key_pair(private_key, address)
         try:
             private_key = private_key.lower().replace('0x', '')
             address = address.lower().replace('0x', '')
@@ -215,12 +456,12 @@ class KeyValidator:
             print("-" * 60)
             
             # Process image
-            img, threshold = self.process_merged_image(image_path)
+            img, gray, threshold = self.process_merged_image(image_path)
             if img is None or threshold is None:
                 return False
             
             # Extract QR codes
-            qr_pairs = self.extract_qr_codes(img, threshold)
+            qr_pairs = self.extract_qr_codes(gray, threshold)
             
             if not qr_pairs:
                 print("No QR code pairs found in image")